@@ -1,39 +1,80 @@
 #!/usr/bin/python
 """Fix broken filesystem permissions"""
 import argparse
+import io
 import logging
+import lzma
 from pathlib import Path
-import re
 import sys
-import tarfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from functools import partial
+from os import O_CLOEXEC
+from os import O_DIRECTORY
+from os import O_RDONLY
 from os import chmod
+from os import close
+from os import cpu_count
 from os import getuid
-from os import lstat
-from os.path import isfile
+from os import open as os_open
+from os import scandir
+from os import stat
+from os.path import join
+from os.path import split
+from shutil import which
 from subprocess import PIPE
+from subprocess import CalledProcessError
+from subprocess import Popen
 from subprocess import run
+from typing import AbstractSet
 from typing import Dict
+from typing import FrozenSet
+from typing import Iterable
 from typing import Iterator
+from typing import List
 from typing import Optional
 from typing import Tuple
 
 import zstandard as zstd
 
-ARCHITECTURE_REGEX = r"Architecture = (.*)"
-PACKAGE_PATH_TEMPLATE = "/var/cache/pacman/pkg/{name}-{version}-{arch}.pkg.{format}"
-PACKAGE_IGNORE = [
-    ".PKGINFO",
-    ".BUILDINFO",
-    ".MTREE",
-    ".INSTALL",
-    ".CHANGELOG",
-    # NOTE: unable to chmod
-    "boot/amd-ucode.img",
-]
+try:
+    import libarchive  # type: ignore
+except ImportError:
+    libarchive = None
+
+try:
+    from typing import Protocol
+except ImportError:  # NOTE: Python < 3.8
+    Protocol = object  # type: ignore
+
+PACKAGE_CACHE_DIR = "/var/cache/pacman/pkg"
+PACKAGE_FILENAME_TEMPLATE = "{name}-{version}-{arch}.pkg.{format}"
+PACKAGE_READ_BUFFER_SIZE = 4 << 20
+ZSTD_READ_SIZE = 1 << 20
+ZSTD_BINARY = which("zstd")
+# NOTE: reused for every package; each pool worker gets its own copy and reads one package at a time
+ZSTD_DECOMPRESSOR = zstd.ZstdDecompressor()
+TAR_BLOCK_SIZE = 512
+TAR_SKIP_CHUNK_SIZE = 1 << 20
+PACKAGE_IGNORE = frozenset(
+    {
+        ".PKGINFO",
+        ".BUILDINFO",
+        ".MTREE",
+        ".INSTALL",
+        ".CHANGELOG",
+        # NOTE: unable to chmod
+        "boot/amd-ucode.img",
+    }
+)
 
 __version__ = "1.1.2"
 
+# NOTE: actual modes of names already stat'ed by this process, None for missing ones;
+# every pool worker keeps its own cache
+_actual_modes: Dict[str, Optional[int]] = {}
+
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 logger = logging.getLogger()
 
@@ -63,6 +104,14 @@ mods.add_argument(
 parser.add_argument(
     "-c", "--clean", action="store_true", help="clean up package cache after processing"
 )
+parser.add_argument(
+    "-w",
+    "--stat-workers",
+    type=int,
+    default=32,
+    help="number of threads used to stat files of each package and to chmod broken ones (default: 32)",
+    metavar="N",
+)
 parser.add_argument(
     "-v", "--version", action="version", version=f"%(prog)s {__version__}"
 )
@@ -72,17 +121,21 @@ if getattr(cli_args, "packages", None) == []:
     parser.error("You must pass at least one package name when using -p switch")
 if getattr(cli_args, "filesystem-paths", None) == []:
     parser.error("You must pass at least one filesystem path when using -f switch")
+if cli_args.stat_workers < 1:
+    parser.error("Number of stat workers must be positive")
 
 
 def _get_arch() -> str:
     """Get system architecture from pacman.conf or from uname if not set explicitly."""
-    arch = "auto"
     with open("/etc/pacman.conf", "r") as file:
-        for line in file:
-            match = re.match(ARCHITECTURE_REGEX, line)
-            if match:
-                arch = match.group(1)
-                break
+        arch = next(
+            (
+                line.split("=", 1)[1].strip()
+                for line in file
+                if line.startswith("Architecture") and "=" in line
+            ),
+            "auto",
+        )
     if arch == "auto":
         result = run(
             ("uname", "-m"),
@@ -93,53 +146,277 @@ def _get_arch() -> str:
     return arch
 
 
-def _get_package_path(name: str, version: str, arch: str) -> Optional[str]:
-    """Get path to package stored in pacman cache."""
+def _list_package_cache() -> FrozenSet[str]:
+    """List file names stored in pacman cache with a single directory scan."""
+    with scandir(PACKAGE_CACHE_DIR) as entries:
+        return frozenset(entry.name for entry in entries if entry.is_file())
+
+
+def _get_package_path(
+    name: str, version: str, arch: str, cache: AbstractSet[str]
+) -> Optional[str]:
+    """Get path to package stored in pacman cache using precomputed cache listing."""
     for _arch in (arch, "any"):
         for _format in ("tar.xz", "tar.zst"):
-            package_path = PACKAGE_PATH_TEMPLATE.format(
+            filename = PACKAGE_FILENAME_TEMPLATE.format(
                 name=name, version=version, arch=_arch, format=_format
             )
-            if isfile(package_path):
-                return package_path
+            if filename in cache:
+                return join(PACKAGE_CACHE_DIR, filename)
     return None
 
 
+def _get_package_paths(
+    package_ids: List[str], arch: str
+) -> Tuple[Dict[str, str], List[str]]:
+    """Get paths to packages stored in pacman cache, download missing ones with a single pacman call.
+
+    Returns package paths by id and ids of downloaded packages.
+    """
+    cache = _list_package_cache()
+    paths: Dict[str, str] = {}
+    missing = []
+    for package_id in package_ids:
+        name, version = package_id.split()
+        path = _get_package_path(name, version, arch, cache)
+        if path is None:
+            missing.append(package_id)
+        else:
+            paths[package_id] = path
+    if not missing:
+        return paths, []
+
+    logger.info("=> %i packages are missing, downloading", len(missing))
+    run(
+        ("pacman", "-Swq", "--noconfirm", *(i.split()[0] for i in missing)),
+        check=True,
+    )
+
+    cache = _list_package_cache()
+    for package_id in missing:
+        name, version = package_id.split()
+        path = _get_package_path(name, version, arch, cache)
+        if path is None:
+            raise Exception(f"Package {package_id} is missing from pacman cache")
+        paths[package_id] = path
+    return paths, missing
+
+
+def _parse_tar_number(field: bytes) -> int:
+    """Parse numeric tar header field, either NUL/space padded octal or GNU base-256."""
+    if field[0] & 0x80:
+        return int.from_bytes(field[1:], "big")
+    field = field.split(b"\0", 1)[0].strip()
+    return int(field, 8) if field else 0
+
+
+def _parse_pax_records(data: bytes) -> Dict[str, str]:
+    """Parse `<length> <key>=<value>` newline-terminated records of pax extended header."""
+    records = {}
+    offset = 0
+    while offset < len(data):
+        length, _, rest = data[offset:].partition(b" ")
+        if not length.isdigit():
+            break
+        end = offset + int(length)
+        key, _, value = rest[: end - offset - len(length) - 1].partition(b"=")
+        records[key.decode()] = value[:-1].decode("utf-8", "surrogateescape")
+        offset = end
+    return records
+
+
+class Readable(Protocol):
+    """Binary stream, possibly returning less bytes than requested."""
+
+    def read(self, size: int) -> bytes: ...
+
+
+def _read_exact(file: Readable, size: int) -> bytes:
+    """Read exactly `size` bytes from a stream, raise if it ends earlier."""
+    chunks = []
+    while size > 0:
+        chunk = file.read(size)
+        if not chunk:
+            raise Exception("Unexpected end of archive")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def _skip(file: Readable, size: int) -> None:
+    """Read and discard `size` bytes from a stream that may not support seeking."""
+    while size > 0:
+        chunk = file.read(min(size, TAR_SKIP_CHUNK_SIZE))
+        if not chunk:
+            raise Exception("Unexpected end of archive")
+        size -= len(chunk)
+
+
+def _iter_tar_members(file: Readable) -> Iterator[Tuple[str, int]]:
+    """Yield names and permission bits of tar members parsing headers only, data blocks are skipped."""
+    long_name: Optional[str] = None
+    pax: Dict[str, str] = {}
+    while True:
+        header = file.read(TAR_BLOCK_SIZE)
+        if not header:
+            return
+        # NOTE: streams like zstd's may return short reads, e.g. at frame boundaries
+        if len(header) < TAR_BLOCK_SIZE:
+            header += _read_exact(file, TAR_BLOCK_SIZE - len(header))
+        if not header.strip(b"\0"):
+            return
+
+        typeflag = header[156:157]
+        size = _parse_tar_number(header[124:136])
+        padded_size = -(-size // TAR_BLOCK_SIZE) * TAR_BLOCK_SIZE
+
+        # NOTE: metadata records describe the member that follows them
+        if typeflag in (b"x", b"X", b"L"):
+            data = _read_exact(file, padded_size)[:size]
+            # NOTE: `X` is the Solaris flavour of pax extended header
+            if typeflag in (b"x", b"X"):
+                pax = _parse_pax_records(data)
+            else:
+                long_name = data.split(b"\0", 1)[0].decode("utf-8", "surrogateescape")
+            continue
+        if typeflag in (b"g", b"K"):
+            _skip(file, padded_size)
+            continue
+
+        # NOTE: sparse files are stored as `<dir>/GNUSparseFile.0/<file>`, real path is in pax record
+        if "GNU.sparse.name" in pax:
+            name = pax["GNU.sparse.name"]
+        elif "path" in pax:
+            name = pax["path"]
+        elif long_name is not None:
+            name = long_name
+        else:
+            name = header[0:100].split(b"\0", 1)[0].decode("utf-8", "surrogateescape")
+            # NOTE: POSIX ustar splits long names into prefix and name
+            if header[257:263] == b"ustar\0" and header[345]:
+                prefix = header[345:500].split(b"\0", 1)[0]
+                name = prefix.decode("utf-8", "surrogateescape") + "/" + name
+        if "size" in pax:
+            size = int(pax["size"])
+            padded_size = -(-size // TAR_BLOCK_SIZE) * TAR_BLOCK_SIZE
+
+        yield name.rstrip("/"), _parse_tar_number(header[100:108]) & 0o7777
+
+        # NOTE: links, devices, directories and fifos carry no data blocks
+        if typeflag not in (b"1", b"2", b"3", b"4", b"5", b"6"):
+            _skip(file, padded_size)
+        long_name, pax = None, {}
+
+
 @contextmanager
-def get_package(
-    name: str, version: str, arch: str, clean: bool = False
-) -> Iterator[tarfile.TarFile]:
-    """Open package from pacman cache, download it if missing."""
-
-    downloaded = False
-    path = _get_package_path(name, version, arch)
-    if path is None:
-        logger.info("=> %s package is missing, downloading", name)
-        run(
-            ("pacman", "-Swq", "--noconfirm", name),
-            check=True,
-        )
-        downloaded = True
-
-    path = _get_package_path(name, version, arch)
-    if path is None:
-        raise Exception
-
-    if path.endswith("xz"):
-        with tarfile.open(path) as package:
-            yield package
-    elif path.endswith("zst"):
-        dctx = zstd.ZstdDecompressor()
-        with open(path, "rb") as file:
-            with dctx.stream_reader(file) as reader:
-                with tarfile.open(fileobj=reader, mode="r|*") as package:
-                    yield package
-    else:
-        raise Exception("Unknown package format")
+def get_package(path: str) -> Iterator[Iterator[Tuple[str, int]]]:
+    """Open package from pacman cache, yield names and permission bits of its members."""
+    if libarchive is not None:
+        # NOTE: libarchive detects compression itself and parses headers in C
+        with libarchive.file_reader(
+            path, block_size=PACKAGE_READ_BUFFER_SIZE
+        ) as archive:
+            yield (
+                (entry.pathname.rstrip("/"), entry.mode & 0o7777) for entry in archive
+            )
+        return
+
+    if path.endswith("zst") and ZSTD_BINARY is not None:
+        # NOTE: decompress in a separate process to overlap it with header parsing
+        command = (ZSTD_BINARY, "-dcq", path)
+        with Popen(command, stdout=PIPE, bufsize=PACKAGE_READ_BUFFER_SIZE) as process:
+            assert process.stdout is not None
+            yield _iter_tar_members(process.stdout)
+            # NOTE: drain end-of-archive padding so zstd doesn't fail with EPIPE
+            process.stdout.read()
+        if process.returncode:
+            raise CalledProcessError(process.returncode, command)
+        return
+
+    with open(path, "rb", buffering=0) as raw, io.BufferedReader(
+        raw, buffer_size=PACKAGE_READ_BUFFER_SIZE
+    ) as file:
+        if path.endswith("xz"):
+            with lzma.open(file) as reader:
+                yield _iter_tar_members(reader)
+        elif path.endswith("zst"):
+            with ZSTD_DECOMPRESSOR.stream_reader(
+                file, read_size=ZSTD_READ_SIZE, read_across_frames=True
+            ) as reader:
+                yield _iter_tar_members(reader)
+        else:
+            raise Exception("Unknown package format")
+
+
+def _get_directory_modes(directory: str, names: Iterable[str]) -> List[Optional[int]]:
+    """Get permission bits of entries of a directory relative to `/` without following symlinks, None for missing ones."""
+    names = list(names)
+    try:
+        dir_fd = os_open("/" + directory, O_RDONLY | O_DIRECTORY | O_CLOEXEC)
+    except FileNotFoundError:
+        return [None] * len(names)
+
+    modes: List[Optional[int]] = []
+    try:
+        for name in names:
+            try:
+                modes.append(
+                    stat(name, dir_fd=dir_fd, follow_symlinks=False).st_mode & 0o7777
+                )
+            except FileNotFoundError:
+                modes.append(None)
+    finally:
+        close(dir_fd)
+    return modes
 
-    if downloaded and clean:
-        logger.info("=> %s package downloaded, cleaning up", name)
-        Path(path).unlink()
+
+def scan_package(
+    package_path: str, stat_workers: int = 32
+) -> List[Tuple[str, int, int]]:
+    """Compare permissions of package files with the actual filesystem ones, return broken ones.
+
+    Paths are returned relative to `/` as stored in package.
+    """
+    broken_paths: List[Tuple[str, int, int]] = []
+
+    # NOTE: local names skip global lookups in the per-member loop
+    ignore, actual_modes = PACKAGE_IGNORE, _actual_modes
+    with get_package(package_path) as members:
+        expected_modes: Dict[str, int] = {}
+        # NOTE: grouped by directory to resolve every directory once
+        unknown: Dict[str, List[str]] = {}
+        for name, mode in members:
+            if name in ignore or name in expected_modes:
+                continue
+            expected_modes[name] = mode
+
+            # NOTE: directories like /usr/share/licenses are shipped by many packages, stat them once
+            if name in actual_modes:
+                continue
+            directory, basename = split(name)
+            unknown.setdefault(directory, []).append(basename)
+
+    with ThreadPoolExecutor(max_workers=stat_workers) as executor:
+        results = executor.map(_get_directory_modes, unknown, unknown.values())
+        for (directory, basenames), old_modes in zip(unknown.items(), results):
+            for basename, old_mode in zip(basenames, old_modes):
+                actual_modes[join(directory, basename)] = old_mode
+
+    for name, new_mode in expected_modes.items():
+        old_mode = actual_modes[name]
+        if old_mode is None:
+            logger.error("File not found: /%s", name)
+            # TODO: Suggest to reinstall package
+        elif old_mode != new_mode:
+            broken_paths.append((name, old_mode, new_mode))
+
+    return broken_paths
+
+
+def _fix_mode(item: Tuple[str, Tuple[int, int]]) -> None:
+    """Set correct permissions of a path relative to `/`."""
+    path, (_, new_mode) = item
+    chmod("/" + path, new_mode)
 
 
 def __main__():
@@ -159,48 +436,61 @@ def __main__():
             check=True,
             stdout=PIPE,
         )
-        package_ids = result.stdout.decode().strip().split("\n")
+        package_ids = [line.decode() for line in result.stdout.splitlines()]
     elif selected_paths:
         result = run(("pacman", "-Qo", *selected_paths), check=True, stdout=PIPE)
-        output = result.stdout.decode().strip().split("\n")
-        package_ids = [" ".join(line.split()[-2:]) for line in output]
+        package_ids = [
+            " ".join(line.decode().split()[-2:]) for line in result.stdout.splitlines()
+        ]
     else:
         result = run(
             ("pacman", "-Qn"),
             check=True,
             stdout=PIPE,
         )
-        package_ids = result.stdout.decode().strip().split("\n")
+        package_ids = [line.decode() for line in result.stdout.splitlines()]
+    # NOTE: several paths may be owned by the same package
+    package_ids = list(dict.fromkeys(package_ids))
     if not package_ids:
         raise Exception("No packages selected")
 
     logger.info(
         "==> Collecting actual filesystem permissions and correct ones from packages"
     )
+    package_paths, downloaded = _get_package_paths(package_ids, arch)
+
+    # NOTE: keys are relative to `/`, prepended only for output and chmod
     broken_paths: Dict[str, Tuple[int, int]] = {}
     package_ids_total = len(package_ids)
 
-    for i, package_id in enumerate(package_ids):
-        logger.info("(%i/%i) %s", i + 1, package_ids_total, package_id)
-        name, version = package_id.split()
+    # NOTE: start the largest packages first so they don't end up as stragglers
+    scheduled_ids = sorted(
+        package_ids,
+        key=lambda package_id: stat(package_paths[package_id]).st_size,
+        reverse=True,
+    )
 
-        with get_package(name, version, arch, cli_args.clean) as package:
-            for file in package.getmembers():
-                if file.name in PACKAGE_IGNORE:
-                    continue
+    with ProcessPoolExecutor(max_workers=cpu_count()) as executor:
+        results = executor.map(
+            partial(scan_package, stat_workers=cli_args.stat_workers),
+            (package_paths[package_id] for package_id in scheduled_ids),
+        )
+        package_results: Dict[str, List[Tuple[str, int, int]]] = {}
+        for i, (package_id, package_broken_paths) in enumerate(
+            zip(scheduled_ids, results)
+        ):
+            logger.info("(%i/%i) %s", i + 1, package_ids_total, package_id)
+            package_results[package_id] = package_broken_paths
 
-                path = "/" + file.name
-                if path in broken_paths:
-                    continue
+    # NOTE: merge in pacman order, so the first listed package wins regardless of scheduling
+    for package_id in package_ids:
+        for path, old_mode, new_mode in package_results[package_id]:
+            broken_paths.setdefault(path, (old_mode, new_mode))
 
-                try:
-                    old_mode = int(lstat(path).st_mode & 0o7777)
-                    new_mode = int(file.mode)
-                    if old_mode != new_mode:
-                        broken_paths[path] = (old_mode, new_mode)
-                except FileNotFoundError:
-                    logger.error("File not found: %s", path)
-                    # TODO: Suggest to reinstall package
+    if downloaded and cli_args.clean:
+        logger.info("=> Cleaning up downloaded packages")
+        for package_id in downloaded:
+            Path(package_paths[package_id]).unlink()
 
     if not broken_paths:
         logger.info("==> Your filesystem is fine, no action required")
@@ -209,15 +499,14 @@ def __main__():
     logger.info("==> Scan completed. Broken permissions in your filesystem:")
     for path, modes in broken_paths.items():
         old_mode, new_mode = modes
-        logging.info("%s: %s => %s", path, oct(old_mode), oct(new_mode))
+        logging.info("/%s: %s => %s", path, oct(old_mode), oct(new_mode))
     logger.info("==> Apply? [Y/n]")
     if input().lower() in ["no", "n"]:
         logger.info("==> Done! (no actual changes were made)")
         return
 
-    for path, modes in broken_paths.items():
-        old_mode, new_mode = modes
-        chmod(path, new_mode)
+    with ThreadPoolExecutor(max_workers=cli_args.stat_workers) as executor:
+        list(executor.map(_fix_mode, broken_paths.items()))
     logger.info("==> Done!")
 
 
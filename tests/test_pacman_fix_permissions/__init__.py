@@ -1 +1,8 @@
-import pacman_fix_permissions
+import sys
+from unittest import mock
+
+# NOTE: module checks for root and parses CLI arguments on import
+with mock.patch("os.getuid", return_value=0), mock.patch.object(
+    sys, "argv", ["pacman-fix-permissions"]
+):
+    import pacman_fix_permissions
@@ -0,0 +1,199 @@
+import io
+import tarfile
+from typing import List
+from typing import Optional
+from typing import Tuple
+from unittest import TestCase
+
+from tests.test_pacman_fix_permissions import pacman_fix_permissions
+
+TAR_BLOCK_SIZE = 512
+
+
+class ShortReader:
+    """Stream returning at most `limit` bytes per read like zstd at frame boundaries."""
+
+    def __init__(self, data: bytes, limit: int) -> None:
+        self._file = io.BytesIO(data)
+        self._limit = limit
+
+    def read(self, size: int = -1) -> bytes:
+        return self._file.read(min(size, self._limit) if size >= 0 else self._limit)
+
+
+def _add(
+    archive: tarfile.TarFile,
+    name: str,
+    type: bytes = tarfile.REGTYPE,
+    mode: int = 0o644,
+    data: bytes = b"",
+    linkname: str = "",
+) -> None:
+    info = tarfile.TarInfo(name)
+    info.type = type
+    info.mode = mode
+    info.linkname = linkname
+    info.size = len(data)
+    archive.addfile(info, io.BytesIO(data) if data else None)
+
+
+def _patch_header(data: bytes, offset: int, field: slice, value: bytes) -> bytes:
+    """Replace header field and recompute checksum."""
+    header = bytearray(data[offset : offset + TAR_BLOCK_SIZE])
+    header[field] = value
+    header[148:156] = b" " * 8
+    header[148:156] = b"%06o\0 " % sum(header)
+    return data[:offset] + bytes(header) + data[offset + TAR_BLOCK_SIZE :]
+
+
+def _header_offset(data: bytes, name: str) -> int:
+    """Get offset of the header block of a member, after pax or GNU metadata records."""
+    with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+        return archive.getmember(name).offset_data - TAR_BLOCK_SIZE
+
+
+def _tarfile_members(data: bytes) -> List[Tuple[str, int]]:
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r|") as archive:
+        return [(member.name, member.mode & 0o7777) for member in archive]
+
+
+def _members(data: bytes, limit: Optional[int] = None) -> List[Tuple[str, int]]:
+    file = ShortReader(data, limit) if limit else io.BytesIO(data)
+    return list(pacman_fix_permissions._iter_tar_members(file))
+
+
+def _build(format: int) -> bytes:
+    file = io.BytesIO()
+    with tarfile.open(fileobj=file, mode="w", format=format) as archive:
+        _add(archive, ".PKGINFO", data=b"pkgname = test\n")
+        _add(archive, "usr", tarfile.DIRTYPE, 0o755)
+        _add(archive, "usr/bin", tarfile.DIRTYPE, 0o755)
+        _add(archive, "usr/bin/tool", mode=0o4755, data=b"\x7fELF" * 1000)
+        _add(archive, "usr/bin/link", tarfile.SYMTYPE, 0o777, linkname="tool")
+        _add(archive, "usr/bin/hard", tarfile.LNKTYPE, 0o4755, linkname="usr/bin/tool")
+        _add(archive, "usr/share/" + "d" * 90 + "/" + "f" * 40, mode=0o600, data=b"x")
+        _add(archive, "var/empty", tarfile.DIRTYPE, 0o3777)
+        _add(archive, "usr/last", mode=0o640, data=b"y" * TAR_BLOCK_SIZE)
+    return file.getvalue()
+
+
+class IterTarMembersTest(TestCase):
+    def test_ustar(self) -> None:
+        data = _build(tarfile.USTAR_FORMAT)
+        # NOTE: the long name doesn't fit the name field and is split into prefix
+        offset = _header_offset(data, "usr/share/" + "d" * 90 + "/" + "f" * 40)
+        self.assertNotEqual(data[offset + 345], 0)
+
+        self.assertEqual(_members(data), _tarfile_members(data))
+        self.assertIn(("usr/bin", 0o755), _members(data))
+        self.assertIn(("var/empty", 0o3777), _members(data))
+
+    def test_gnu_long_name(self) -> None:
+        file = io.BytesIO()
+        with tarfile.open(fileobj=file, mode="w", format=tarfile.GNU_FORMAT) as archive:
+            _add(archive, "usr/" + "n" * 200, mode=0o755, data=b"data")
+            _add(
+                archive, "usr/" + "l" * 200, tarfile.SYMTYPE, 0o777, linkname="t" * 200
+            )
+            _add(archive, "usr/short", mode=0o600)
+        data = file.getvalue()
+        self.assertIn(b"././@LongLink", data)
+
+        self.assertEqual(_members(data), _tarfile_members(data))
+        self.assertEqual(_members(data)[0], ("usr/" + "n" * 200, 0o755))
+
+    def test_pax(self) -> None:
+        data = _build(tarfile.PAX_FORMAT)
+        self.assertEqual(_members(data), _tarfile_members(data))
+
+        file = io.BytesIO()
+        with tarfile.open(fileobj=file, mode="w", format=tarfile.PAX_FORMAT) as archive:
+            _add(archive, "usr/" + "ü" * 150, mode=0o750, data=b"z" * 700)
+            _add(archive, "usr/short", mode=0o600)
+        data = file.getvalue()
+
+        self.assertEqual(_members(data), _tarfile_members(data))
+        self.assertEqual(_members(data)[0], ("usr/" + "ü" * 150, 0o750))
+
+    def test_pax_size(self) -> None:
+        file = io.BytesIO()
+        with tarfile.open(fileobj=file, mode="w", format=tarfile.PAX_FORMAT) as archive:
+            info = tarfile.TarInfo("usr/big")
+            info.size = 700
+            info.pax_headers = {"size": "700"}
+            archive.addfile(info, io.BytesIO(b"b" * 700))
+            _add(archive, "usr/after", mode=0o600)
+        data = file.getvalue()
+        # NOTE: header size field is overridden by pax record
+        offset = _header_offset(data, "usr/big")
+        data = _patch_header(data, offset, slice(124, 136), b"%011o\0" % 0)
+
+        self.assertEqual(_members(data), _tarfile_members(data))
+        self.assertEqual(_members(data), [("usr/big", 0o644), ("usr/after", 0o600)])
+
+    def test_solaris_pax(self) -> None:
+        file = io.BytesIO()
+        with tarfile.open(fileobj=file, mode="w", format=tarfile.PAX_FORMAT) as archive:
+            _add(archive, "usr/" + "s" * 150, mode=0o750, data=b"z" * 700)
+            _add(archive, "usr/short", mode=0o600)
+        data = _patch_header(file.getvalue(), 0, slice(156, 157), b"X")
+
+        self.assertEqual(_members(data), _tarfile_members(data))
+        self.assertEqual(_members(data)[0], ("usr/" + "s" * 150, 0o750))
+
+    def test_pax_sparse(self) -> None:
+        # NOTE: laid out like bsdtar does: GNU sparse 1.0 map precedes data blocks
+        sparse_map = b"1\n600000\n4\n".ljust(TAR_BLOCK_SIZE, b"\0")
+        file = io.BytesIO()
+        with tarfile.open(fileobj=file, mode="w", format=tarfile.PAX_FORMAT) as archive:
+            _add(archive, "usr", tarfile.DIRTYPE, 0o755)
+            info = tarfile.TarInfo("usr/GNUSparseFile.0/sparse")
+            info.mode = 0o640
+            info.size = len(sparse_map) + 4
+            info.pax_headers = {
+                "GNU.sparse.major": "1",
+                "GNU.sparse.minor": "0",
+                "GNU.sparse.name": "usr/sparse",
+                "GNU.sparse.realsize": "1048576",
+            }
+            archive.addfile(info, io.BytesIO(sparse_map + b"data"))
+            _add(archive, "usr/after", mode=0o600)
+        data = file.getvalue()
+
+        self.assertEqual(_members(data), _tarfile_members(data))
+        self.assertEqual(
+            _members(data),
+            [("usr", 0o755), ("usr/sparse", 0o640), ("usr/after", 0o600)],
+        )
+
+    def test_base256_size(self) -> None:
+        file = io.BytesIO()
+        with tarfile.open(fileobj=file, mode="w", format=tarfile.GNU_FORMAT) as archive:
+            _add(archive, "usr/big", data=b"b" * 700)
+            _add(archive, "usr/after", mode=0o600)
+        data = file.getvalue()
+        size = b"\x80" + (700).to_bytes(11, "big")
+        data = _patch_header(data, 0, slice(124, 136), size)
+
+        self.assertEqual(_members(data), _tarfile_members(data))
+        self.assertEqual(_members(data), [("usr/big", 0o644), ("usr/after", 0o600)])
+
+    def test_short_reads(self) -> None:
+        for format in (tarfile.USTAR_FORMAT, tarfile.GNU_FORMAT, tarfile.PAX_FORMAT):
+            data = _build(format)
+            for limit in (1, 100, 511, 513, 4000):
+                with self.subTest(format=format, limit=limit):
+                    self.assertEqual(_members(data, limit), _tarfile_members(data))
+
+    def test_truncated(self) -> None:
+        data = _build(tarfile.PAX_FORMAT)
+        data_offset = _header_offset(data, "usr/bin/tool") + TAR_BLOCK_SIZE
+        for size in (100, TAR_BLOCK_SIZE + 100, data_offset + 100):
+            with self.subTest(size=size):
+                with self.assertRaises(Exception):
+                    _members(data[:size])
+
+    def test_end_of_archive(self) -> None:
+        data = _build(tarfile.USTAR_FORMAT)
+        self.assertEqual(_members(data + b"garbage"), _tarfile_members(data))
+        self.assertEqual(_members(b""), [])